@@ -0,0 +1,83 @@
+# Measures how long PostArchives and ReadersCorner take to build their archives
+# for a growing number of synthetic entries.
+#
+#   python benchmarks/archives.py [--counts 1000 10000 100000] [--repeat 3]
+
+import argparse, json, os, random, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import halwa
+
+routes = {
+    'post' : '/blog/{year}/{month}/{slug}/',
+    'readerscornerpge' : '/readerscorner/{year}/{month}/',
+    'readerscornerhome' : '/readerscorner/',
+    'readerscornersearch' : '/readerscorner/search/',
+}
+
+def make_posts(app, count, rnd):
+    posts = []
+    for i in range(count):
+        post = halwa.BlogPost(app, 'post%d.md' % i)
+        post.metadata = {'year' : '%d' % rnd.randint(2000, 2015), 'month' : '%02d' % rnd.randint(1, 12), 'day' : '%02d' % rnd.randint(1, 28), 'slug' : 'post%d' % i}
+        posts.append(post)
+    return posts
+
+def make_entries(count, rnd):
+    words = ['word%d' % i for i in range(500)]
+    entries = []
+    for i in range(count):
+        entries.append({
+            'created_time' : '%d-%02d-%02dT%02d:%02d:%02d+0000' % (rnd.randint(2000, 2015), rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59)),
+            'link' : 'http://example.com/%d' % i,
+            'name' : 'Entry %d' % i,
+            'message' : ' '.join(rnd.sample(words, 8)),
+        })
+    return entries
+
+def best(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark archive construction.')
+    parser.add_argument('--counts', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        os.makedirs('templates')
+        app = halwa.Engine({'templates' : 'templates', 'output' : 'output'}, routes, [], [], {})
+        rnd = random.Random(0)
+
+        print('%10s %14s %16s %16s' % ('entries', 'postarchives', 'readerscorner', 'rc archives'))
+        for count in args.counts:
+            posts = make_posts(app, count, rnd)
+            archives = halwa.PostArchives(app)
+            tposts = best(lambda: archives.process(posts, {}), args.repeat)
+
+            with open('readerscorner.json', 'w') as f:
+                json.dump(make_entries(count, rnd), f)
+            readerscorner = halwa.ReadersCorner(app, 'readerscorner.json')
+            def process():
+                app.cache.store.pop('readerscorner.json', None)
+                return readerscorner.process([], {})
+            data = process()
+            entries = [e for y in data['readerscorner'].values() for m in y.values() for d in m.values() for e in d]
+            tprocess = best(process, args.repeat)
+            tarchives = best(lambda: readerscorner.build_archives(entries), args.repeat)
+
+            print('%10d %13.3fs %15.3fs %15.3fs' % (count, tposts, tprocess, tarchives))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
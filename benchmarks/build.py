@@ -0,0 +1,137 @@
+# Times full builds of a synthetic site (see synthetic.py), stage by stage:
+#
+#   cold     no cache and no output
+#   warm     nothing changed since the previous build
+#   change   one blog post changed since the previous build
+#
+# Each stage is the best of --repeat runs. Pass --json to get the results in a
+# machine readable form, e.g. to compare them across versions.
+#
+# Afterwards a post's excerpt, which no template shows, is changed and the site
+# rebuilt once more: every regenerated page comes out identical, so none of
+# them may be rewritten.
+#
+#   python benchmarks/build.py [--posts 1000] [--entries 10000] [--repeat 3] [--json]
+
+import argparse, json, os, platform, shutil, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import halwa
+import synthetic
+
+stages = ['init', 'load', 'process', 'generate', 'shutdown', 'total']
+
+def build(site, options):
+    times = {}
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        app = halwa.Engine(*site, **options)
+        times['init'] = time.time() - start
+        for (stage, fn) in [('load', app.load_content), ('process', app.process_content), ('generate', app.generate_output), ('shutdown', app.cache.shutdown)]:
+            begin = time.time()
+            fn()
+            times[stage] = time.time() - begin
+        times['total'] = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return times
+
+def clean():
+    for path in ['output', 'cache', 'cache.db']:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    os.makedirs('output')
+
+def change(index):
+    path = synthetic.post_path(index)
+    with open(path, 'a') as f:
+        f.write('\nChanged %d.\n' % index)
+    # the cache keeps whole seconds, so let the next build start in a later one
+    time.sleep(1 - time.time() % 1)
+
+def touch(index):
+    # changes metadata that is not rendered anywhere
+    path = synthetic.post_path(index)
+    with open(path) as f:
+        text = f.read()
+    with open(path, 'w') as f:
+        f.write(text.replace('"excerpt": "', '"excerpt": "changed ', 1))
+    time.sleep(1 - time.time() % 1)
+
+def rewritten(site, options):
+    options = dict(options, profiler=halwa.Profiler(True))
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        app = halwa.Engine(*site, **options)
+        app.generate()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return app.profiler.counters['files written']
+
+def best(runs):
+    return dict((stage, min(run[stage] for run in runs)) for stage in stages)
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cold, warm and incremental builds of a synthetic site.')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--tags', type=int, default=50)
+    parser.add_argument('--entries', type=int, default=10000)
+    parser.add_argument('--static', type=int, default=100)
+    parser.add_argument('--paragraphs', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-j', '--workers', type=int, default=1)
+    parser.add_argument('--digests', action='store_true')
+    parser.add_argument('--store', choices=sorted(halwa.Cache.stores.keys()), default='json')
+    parser.add_argument('--static-mode', choices=list(halwa.Engine.statics.keys()), default='copy', help='how static files are put in place, as --static for halwa')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    options = {'workers' : args.workers, 'digests' : args.digests, 'store' : args.store, 'static' : args.static_mode}
+    root = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        site = synthetic.make_site(os.curdir, args.posts, args.tags, args.entries, args.static, args.paragraphs)
+
+        results = {'cold' : [], 'warm' : [], 'change' : []}
+        for i in range(args.repeat):
+            clean()
+            results['cold'].append(build(site, options))
+            results['warm'].append(build(site, options))
+            change(i % args.posts)
+            results['change'].append(build(site, options))
+        results = dict((scenario, best(runs)) for (scenario, runs) in results.items())
+        touch(0)
+        written = rewritten(site, options)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+    if written:
+        sys.exit('%d identical outputs were rewritten' % written)
+
+    if args.json:
+        settings = dict(vars(args))
+        del settings['json']
+        print(json.dumps({'version' : version(), 'python' : platform.python_version(), 'settings' : settings, 'results' : results}, indent=1, sort_keys=True))
+        return
+
+    print('%10s' % 'scenario' + ''.join('%11s' % stage for stage in stages))
+    for scenario in ['cold', 'warm', 'change']:
+        print('%10s' % scenario + ''.join('%10.3fs' % results[scenario][stage] for stage in stages))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+# Generates a synthetic site for the benchmarks: blog posts with tags and dates,
+# haml templates using inheritance, pages built from processor output, a
+# ReadersCorner JSON export and some static files.
+#
+#   python benchmarks/synthetic.py directory [--posts 1000] [--entries 10000] ...
+#
+# make_site returns the arguments for halwa.Engine, relative to the directory.
+
+import argparse, json, os, random, time
+
+base_template = '''%html
+  %head
+    %title << {{ title }}
+  %body
+    -block body:
+    %ul
+      -for k, v in sidebar.links.items():
+        %li << {{ k }} {{ v }}
+    %ul
+      -for tag in sidebar.tags:
+        %li << {{ tag.tag }}
+'''
+
+post_template = '''-extends 'base.haml'
+-block body:
+  %h1 << {{ title }}
+  %p << {{ year }}/{{ month }}/{{ day }}
+  %div << {{ content }}
+  %ul
+    -for tag in tags:
+      %li << {{ tag }}
+'''
+
+pages = {
+    'index.haml' : ({'route' : 'index'}, '''%html
+  %body
+    -for p in posts:
+      %a href="{{ p.url }}" << {{ p.title }}
+    -for y, months in blogarchives.items():
+      %h2 << {{ y }} {{ len(months) }}
+    %p << {{ blogrss.title }}
+'''),
+    'sitemap.xml' : ({'route' : 'sitemap'}, '''%urlset
+  -for u in sitemap:
+    %url << {{ u }}
+'''),
+    'tag.haml' : ({'route' : 'tag'}, '''%html
+  %body
+    %h1 << {{ tagname }}
+    -for p in tagposts:
+      %a href="{{ p.url }}" << {{ p.title }}
+'''),
+    'readerscorner.haml' : ({'route' : 'readerscornerpge'}, '''%html
+  %body
+    %h1 << {{ monthname }} {{ year }}
+    -for day, entries in montharchive.items():
+      -for e in entries:
+        %p << {{ e.name }} {{ e.timestamp }} {{ e.message }}
+    -for year, months in readerscornersidebar.items():
+      %p << {{ year }}
+'''),
+    'readerscornersearch.haml' : ({'route' : 'readerscornersearch'}, '''%p << {{ readerscornerindex|length }}
+'''),
+}
+
+routes = {
+    'index' : '/',
+    'blog' : '/blog/',
+    'post' : '/blog/{year}/{month}/{slug}/',
+    'tag' : '/blog/tag/{tag}/',
+    'sitemap' : '/sitemap.xml',
+    'readerscornerpge' : '/readerscorner/{year}/{month}/',
+    'readerscornerhome' : '/readerscorner/',
+    'readerscornersearch' : '/readerscorner/search/',
+}
+
+sources = [
+    ('StaticContent', 'content/static/*', {}, []),
+    ('BlogPost', 'content/posts/*.md', {'blogsidebar' : 'sidebar'}, ['templates/post.haml', 'templates/base.haml', 'blogsidebar']),
+    ('Page', 'content/index.haml', {}, ['posts', 'blogarchives', 'blogrss']),
+    ('Page', 'content/sitemap.xml', {}, ['sitemap']),
+    ('TagPage', 'content/tag.haml', {}, ['tags']),
+    ('ReadersCornerPage', 'content/readerscorner.haml', {}, ['readerscorner', 'readerscornersidebar']),
+    ('Page', 'content/readerscornersearch.haml', {}, ['readerscornerindex']),
+]
+
+processors = [
+    ('TagList', {}),
+    ('BlogSidebar', {}),
+    ('PostList', {}),
+    ('PostArchives', {}),
+    ('ReadersCorner', {'filename' : 'readerscorner.json'}),
+    ('RSSFeed', {}),
+    ('Sitemap', {}),
+]
+
+words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor',
+         'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'enim', 'ad', 'minim', 'veniam', 'quis']
+
+def write(path, text, mtime):
+    with open(path, 'w') as f:
+        f.write(text)
+    # the cache only trusts files older than the second it was written in
+    os.utime(path, (mtime, mtime))
+
+def post_path(index):
+    return os.path.join('content', 'posts', 'post%06d.md' % index)
+
+def make_post(index, rnd, tags, paragraphs):
+    metadata = {
+        'route' : 'post',
+        'template' : 'post.haml',
+        'title' : 'Post %d' % index,
+        'date' : '%d/%02d/%02d' % (rnd.randint(2000, 2015), rnd.randint(1, 12), rnd.randint(1, 28)),
+        'tags' : rnd.sample(tags, min(3, len(tags))),
+        'excerpt' : ' '.join(rnd.sample(words, 10)),
+    }
+    body = ['# Post %d' % index]
+    for i in range(paragraphs):
+        body.append(' '.join(rnd.choice(words) for j in range(60)) + ' *%s* `%s`.' % tuple(rnd.sample(words, 2)))
+        if i % 4 == 3:
+            body.append('\n'.join('- ' + rnd.choice(words) for j in range(4)))
+    return json.dumps(metadata, indent=4) + '\n\n' + '\n\n'.join(body) + '\n'
+
+def make_entry(index, rnd):
+    return {
+        'created_time' : '%d-%02d-%02dT%02d:%02d:%02d+0000' % (rnd.randint(2000, 2015), rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59)),
+        'link' : 'http://example.com/%d' % index,
+        'name' : 'Entry %d' % index,
+        'message' : ' '.join(rnd.sample(words, 8)),
+        'description' : ' '.join(rnd.sample(words, 12)),
+    }
+
+def make_site(root, posts=1000, tags=50, entries=10000, static=100, paragraphs=8, seed=0):
+    rnd = random.Random(seed)
+    mtime = time.time() - 60
+    for directory in ['templates', 'output', os.path.join('content', 'posts'), os.path.join('content', 'static')]:
+        if not os.path.exists(os.path.join(root, directory)):
+            os.makedirs(os.path.join(root, directory))
+
+    write(os.path.join(root, 'templates', 'base.haml'), base_template, mtime)
+    write(os.path.join(root, 'templates', 'post.haml'), post_template, mtime)
+    for (name, (metadata, body)) in pages.items():
+        write(os.path.join(root, 'content', name), json.dumps(metadata, indent=4) + '\n\n' + body, mtime)
+
+    names = ['tag%d' % i for i in range(tags)]
+    for i in range(posts):
+        write(os.path.join(root, post_path(i)), make_post(i, rnd, names, paragraphs), mtime)
+    for i in range(static):
+        write(os.path.join(root, 'content', 'static', 'static%d.css' % i), 'body { color: #%06x; }\n' % i * 50, mtime)
+    write(os.path.join(root, 'readerscorner.json'), json.dumps([make_entry(i, rnd) for i in range(entries)]), mtime)
+
+    directories = {'templates' : 'templates', 'output' : 'output'}
+    data = {'blogsidebarroutes' : {'Blog' : 'blog', 'Home' : 'index'}}
+    return (directories, dict(routes), list(sources), list(processors), data)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic site.')
+    parser.add_argument('directory')
+    parser.add_argument('--posts', type=int, default=1000)
+    parser.add_argument('--tags', type=int, default=50)
+    parser.add_argument('--entries', type=int, default=10000)
+    parser.add_argument('--static', type=int, default=100)
+    parser.add_argument('--paragraphs', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    (directories, routes, sources, processors, data) = make_site(args.directory, args.posts, args.tags, args.entries, args.static, args.paragraphs, args.seed)
+    with open(os.path.join(args.directory, 'config.py'), 'w') as f:
+        for (name, value) in [('directories', directories), ('routes', routes), ('sources', sources), ('processors', processors), ('data', data)]:
+            f.write('%s = %r\n' % (name, value))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Measures how long DynamicContent.update, and update followed by render (which
+# works out the output path, checks the cache and writes a small page), take
+# for a fixed number of content objects as the number of keys in the global
+# data dictionary grows.
+#
+#   python benchmarks/update.py [--items 1000] [--keys 10 100 1000 10000] [--repeat 3]
+
+import argparse, os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import halwa
+
+def best(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark DynamicContent.update and rendering.')
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--keys', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        os.makedirs('templates')
+        app = halwa.Engine({'templates' : 'templates', 'output' : 'output'}, {'page' : '/{slug}/'}, [], [], {})
+
+        items = []
+        for i in range(args.items):
+            item = halwa.Page(app, 'page%d.haml' % i, {'key0' : 'renamed'})
+            item.metadata = {'route' : 'page', 'slug' : 'page%d' % i, 'title' : 'Page %d' % i}
+            item.content = '%p << {{ title }} {{ url_for(route=route, slug=slug) }}\n'
+            items.append(item)
+
+        print('%10s %10s %12s %14s %12s %14s' % ('items', 'keys', 'update', 'per item', 'render', 'per item'))
+        for count in args.keys:
+            data = dict(('key%d' % i, list(range(10))) for i in range(count))
+            def update():
+                for item in items:
+                    item.update(data)
+            def render():
+                for item in items:
+                    item.update(data)
+                    item.render()
+            updating = best(update, args.repeat)
+            rendering = best(render, args.repeat)
+            print('%10d %10d %11.4fs %12.2fus %11.4fs %12.2fus' % (args.items, count, updating, updating * 1e6 / args.items, rendering, rendering * 1e6 / args.items))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,204 @@
-import json, calendar, shutil, sys, os, os.path, glob, shelve, time, pprint, imp, re
+import json, calendar, shutil, sys, os, os.path, glob, shelve, time, pprint, imp, re, string, fnmatch, argparse, multiprocessing, multiprocessing.pool, hashlib, sqlite3, select, ctypes, ctypes.util, gc, traceback
 from markdown import markdown
-from collections import OrderedDict, Counter, namedtuple, MutableMapping
-from jinja2 import Environment, FileSystemLoader
+from collections import OrderedDict, Counter, namedtuple, Mapping, MutableMapping
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 if sys.version_info[0] == 2:
     reload(sys)
     sys.setdefaultencoding('utf8')
 
+class Record(MutableMapping):
+    
+    # underscored so they can't shadow metadata keys in templates, which look
+    # up attributes before items
+    __slots__ = ('_layout', '_values')
+    _layouts = {}
+    
+    def __init__(self, pairs=()):
+        if isinstance(pairs, Mapping):
+            pairs = pairs.items()
+        keys = []
+        values = []
+        index = {}
+        for (k, v) in pairs:
+            if k in index:
+                values[index[k]] = v
+            else:
+                index[k] = len(keys)
+                keys.append(k)
+                values.append(v)
+        self._layout = self._get_layout(tuple(keys))
+        self._values = values
+    
+    def _get_layout(self, keys):
+        layout = self._layouts.get(keys)
+        if layout is None:
+            layout = self._layouts[keys] = (keys, dict((k, i) for (i, k) in enumerate(keys)))
+        return layout
+    
+    def __getitem__(self, key):
+        return self._values[self._layout[1][key]]
+    
+    def __setitem__(self, key, value):
+        i = self._layout[1].get(key)
+        if i is None:
+            self._layout = self._get_layout(self._layout[0] + (key,))
+            self._values.append(value)
+        else:
+            self._values[i] = value
+    
+    def __delitem__(self, key):
+        i = self._layout[1][key]
+        self._layout = self._get_layout(self._layout[0][:i] + self._layout[0][i+1:])
+        del self._values[i]
+    
+    def __contains__(self, key):
+        return key in self._layout[1]
+    
+    def __iter__(self):
+        return iter(self._layout[0])
+    
+    def __len__(self):
+        return len(self._values)
+    
+    def __repr__(self):
+        return 'Record(%r)' % list(self.items())
+
+class DataLayers(MutableMapping):
+    
+    def __init__(self, *layers):
+        self.locals = {}
+        self.layers = layers
+    
+    def __getitem__(self, key):
+        if key in self.locals:
+            return self.locals[key]
+        for layer in self.layers:
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+    
+    def __setitem__(self, key, value):
+        self.locals[key] = value
+    
+    def __delitem__(self, key):
+        del self.locals[key]
+    
+    def __contains__(self, key):
+        return key in self.locals or any(key in layer for layer in self.layers)
+    
+    def __iter__(self):
+        seen = set()
+        for layer in (self.locals,) + self.layers:
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+    
+    def __len__(self):
+        return sum(1 for key in self)
+    
+    def copy(self):
+        return dict(self)
+
+class MappedData(Mapping):
+    
+    def __init__(self, data, mappings):
+        self.data = data
+        self.mappings = mappings
+        self.sources = dict((v, k) for (k, v) in mappings.items())
+    
+    def __getitem__(self, key):
+        source = self.sources.get(key)
+        if source is not None and source in self.data:
+            return self.data[source]
+        if self.mappings.get(key, key) != key:
+            raise KeyError(key)
+        return self.data[key]
+    
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+    
+    def __iter__(self):
+        for key in self.data:
+            yield self.mappings.get(key, key)
+    
+    def __len__(self):
+        return len(self.data)
+
+def _hardlink(source, target):
+    os.link(source, target)
+
+def _reflink(source, target):
+    # FICLONE shares the source's extents on btrfs, xfs and similar
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this platform')
+    with open(source, 'rb') as src:
+        with open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), 0x40049409, src.fileno())
+    shutil.copymode(source, target)
+
+def _copy_range(source, target):
+    # copies inside the kernel, without the data passing through python
+    copy = getattr(os, 'copy_file_range', None)
+    if copy is None:
+        copy = lambda src, dst, count: os.sendfile(dst, src, None, count)
+    with open(source, 'rb') as src:
+        with open(target, 'wb') as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            while remaining > 0:
+                sent = copy(src.fileno(), dst.fileno(), remaining)
+                if sent == 0:
+                    break
+                remaining -= sent
+    shutil.copymode(source, target)
+
+def _read_header(path):
+    # Reads only as far as the '}' line closing a file's metadata, plus the
+    # separator line after it. Returns the metadata text, the line the
+    # content starts on, and the file offset of that line.
+    with open(path) as f:
+        lines = []
+        offsets = []
+        line = f.readline()
+        while line:
+            lines.append(line)
+            if line == '}\n':
+                f.readline()
+                return ''.join(lines), len(lines)+1, f.tell()
+            if len(offsets) < 2:
+                offsets.append(f.tell())
+            line = f.readline()
+        
+        # No closing brace, so the metadata is the first line and the content
+        # starts two lines in.
+        offsets.extend([f.tell()] * (2 - len(offsets)))
+        return ''.join(lines[:1]), 2, offsets[1]
+
+def _encode(value):
+    if isinstance(value, Mapping):
+        return OrderedDict(value.items())
+    raise TypeError('%r is not JSON serializable' % value)
+
 class Content(object):
     
     def __init__(self, app, path):
         self.app = app
         self.path = path
+        self.source = None
     
     def load(self):
         pass
@@ -19,8 +206,14 @@ class Content(object):
     def update(self, data):
         pass
     
+    def depends(self):
+        return [self.path]
+    
     def render(self):
         pass
+    
+    def release(self):
+        pass
 
 class StaticContent(Content):
     
@@ -35,10 +228,11 @@ class StaticContent(Content):
     
     def render(self):
         path = self.app.get_output_path(self.path, static=True)
-        status = self.app.cache.need_update(path, [self.path])
+        status = self.app.cache.need_update(path, self.depends())
         
-        if status != 'Ignore':
-            shutil.copy(self.path, path)
+        if status != 'Ignore' and not self.app.dry_run:
+            if not self.app.copy_output(self.path, path):
+                status = 'Unchanged'
         return [(status, path)]
 
 class DynamicContent(Content):
@@ -58,37 +252,46 @@ class DynamicContent(Content):
         self.content = None
         self.data = {}
         self.content_line = 0
+        self.content_offset = None
         status, val = self.app.cache.get_file(self.path)
         
         if status == 'Cached':
             self.metadata = val['metadata']
+            if self.app.lowmem:
+                self.metadata = Record(self.metadata)
             self.content_line = val['content_line']
+            self.content_offset = val.get('content_offset')
         else:
-            stream = []
-            with open(self.app.get_path(self.path)) as f:
-                stream = f.readlines()
-            
-            idx = 0
-            lis = [i for (i,x) in enumerate(stream) if x == '}\n']
-            if len(lis) > 0:
-                idx = lis[0]
-            self.content_line = idx+2
+            header = self.app.headers.pop(self.path, None)
+            if header is None:
+                header = _read_header(self.app.get_path(self.path))
+            header, self.content_line, self.content_offset = header
             
-            metadata = ''.join(stream[:idx+1])
-            self.metadata = json.loads(metadata, object_pairs_hook=OrderedDict)
+            self.metadata = json.loads(header, object_pairs_hook=Record if self.app.lowmem else OrderedDict)
             
-            self.app.cache.put_file(self.path, {'metadata': self.metadata, 'content_line': self.content_line})
+            self.app.cache.put_file(self.path, {'metadata': self.metadata, 'content_line': self.content_line, 'content_offset': self.content_offset})
             
         self.set_url()
         
         return status
     
     def load_content(self):
-        stream = []
         with open(self.app.get_path(self.path)) as f:
-            stream = f.readlines()[self.content_line:]
-        
-        self.content = ''.join(stream)
+            if self.content_offset is not None:
+                f.seek(self.content_offset)
+                self.content = f.read()
+            else:
+                self.content = ''.join(f.readlines()[self.content_line:])
+    
+    def release(self):
+        self.content = None
+        self.data = {}
+    
+    def depends(self):
+        deps = [self.path]
+        if self.dependencies is not None:
+            deps.extend(self.dependencies)
+        return deps
     
     def set_url(self):
         try:
@@ -97,29 +300,38 @@ class DynamicContent(Content):
             pass
     
     def update(self, data):
-        
-        for (k,v) in data.items():
-            key = self.mappings.get(k, k)
-            self.data[key] = v
-        
-        self.data['url_for'] = self.app.url_for
-        self.data['len'] = len
-        self.data.update(self.metadata)
+        self.data = DataLayers(self.metadata, {'url_for' : self.app.url_for, 'len' : len}, MappedData(data, self.mappings))
     
-    def render(self):
+    def generate(self, template):
+        # Hands the data layers to jinja as they are; template.render(**data)
+        # would copy every key of the global data for each page.
+        context = template.new_context(DataLayers(self.data, template.globals), shared=True)
+        try:
+            for chunk in template.root_render_func(context):
+                yield chunk
+        except Exception:
+            template.environment.handle_exception()
+    
+    def render(self, dependencies=None, fingerprint=None):
         
-        path = self.app.get_output_path(self.app.url_for(**self.data))
-        deps = [self.path]
-        if self.dependencies is not None:
-            deps.extend(self.dependencies)
-        status = self.app.cache.need_update(path, deps)
+        path = self.app.get_output_path(self.app.url_from(self.data))
+        if dependencies is None:
+            dependencies = self.depends()
+        status = self.app.cache.need_update(path, dependencies, fingerprint)
 
-        if status != 'Ignore':
+        if status != 'Ignore' and not self.app.dry_run:
             if self.content is None:
                 self.load_content()
             template = self._render()
-            with open(path, 'w') as f:
-                f.write(template.render(**self.data))
+            with self.app.profiler.span('template', self.data.get('template', self.path)):
+                if self.app.stream and hasattr(template, 'new_context'):
+                    written = self.app.stream_output(path, self.generate(template))
+                elif hasattr(template, 'new_context'):
+                    written = self.app.write_output(path, ''.join(self.generate(template)))
+                else:
+                    written = self.app.write_output(path, template.render(self.data))
+                if not written:
+                    status = 'Unchanged'
         
         return [(status, path)]
 
@@ -132,13 +344,14 @@ class Page(DynamicContent):
         return super(Page, self).load()
     
     def _render(self):
-        return self.app.jinja_env.hamlish_from_string(self.content)
+        return self.app.compile_template(self.content, self.path)
 
 class MultiDynamicContent(DynamicContent):
 
+    slices = ()
+
     def __init__(self, app, path, mappings=None, dependencies=None):
         super(MultiDynamicContent, self).__init__(app, path, mappings, dependencies)
-        self.template = None
     
     def load(self):
         return super(MultiDynamicContent,self).load()
@@ -150,15 +363,25 @@ class MultiDynamicContent(DynamicContent):
         return NotImplementedError()
 
     def need_update(self):
-        updated = False
-        for dep in (self.dependencies + [self.path]):
-            if dep in self.app.cache.updated_content:
-                updated = True
-        
-        return updated
+        return self in self.app.dirty
+    
+    def without_slices(self):
+        return [d for d in self.depends() if self.mappings.get(d, d) not in self.slices]
+    
+    def slice_dependencies(self):
+        # A page only stops depending on the whole of the sliced value when
+        # its source says it uses nothing but its own slice.
+        if not self.metadata.get('sliced', False):
+            return self.depends()
+        return self.without_slices()
+    
+    def render_slice(self, value):
+        return super(MultiDynamicContent, self).render(self.slice_dependencies(), self.app.cache.fingerprint(value))
 
 class TagPage(MultiDynamicContent):
     
+    slices = ('tags',)
+    
     def __init__(self, app, path, mappings=None, dependencies=None):
         super(TagPage, self).__init__(app, path, mappings, dependencies)
     
@@ -166,10 +389,7 @@ class TagPage(MultiDynamicContent):
         return super(TagPage,self).load()
     
     def _render(self):
-        if self.template is None:
-            self.template = self.app.jinja_env.hamlish_from_string(self.content)
-        
-        return self.template
+        return self.app.compile_template(self.content, self.path)
     
     def render(self):
 
@@ -181,12 +401,14 @@ class TagPage(MultiDynamicContent):
             self.data['tag'] = tag['tag']
             self.data['tagname'] = tag['tag']
             self.data['tagposts'] = tag['posts']
-            rets.extend(super(TagPage, self).render())
+            rets.extend(self.render_slice(tag))
         
         return rets
 
 class ReadersCornerPage(MultiDynamicContent):
     
+    slices = ('readerscorner',)
+    
     def __init__(self, app, path, mappings=None, dependencies=None):
         super(ReadersCornerPage, self).__init__(app, path, mappings, dependencies)
     
@@ -194,10 +416,7 @@ class ReadersCornerPage(MultiDynamicContent):
         return super(ReadersCornerPage,self).load()
     
     def _render(self):
-        if self.template is None:
-            self.template = self.app.jinja_env.hamlish_from_string(self.content)
-        
-        return self.template
+        return self.app.compile_template(self.content, self.path)
     
     def render(self):
 
@@ -212,12 +431,14 @@ class ReadersCornerPage(MultiDynamicContent):
                 self.data['month'] = month
                 self.data['montharchive'] = montharchive
                 self.data['monthname'] = calendar.month_name[int(month)]
-                rets.extend(super(ReadersCornerPage, self).render())
+                rets.extend(self.render_slice([year, month, montharchive]))
         
         return rets
 
 class ReadersCornerJSONItem(MultiDynamicContent):
     
+    slices = ('readerscorner',)
+    
     def __init__(self, app, path, mappings=None, dependencies=None):
         super(ReadersCornerJSONItem, self).__init__(app, path, mappings, dependencies)
         self.renderfn = namedtuple('Template', ['render'])
@@ -226,8 +447,8 @@ class ReadersCornerJSONItem(MultiDynamicContent):
         return super(ReadersCornerJSONItem,self).load()
     
     def _render(self):
-        def __render(**kwargs):
-            return json.dumps(kwargs['entry']).replace('\\n', '<br>')
+        def __render(data):
+            return json.dumps(data['entry']).replace('\\n', '<br>')
         return self.renderfn(__render)
     
     def render(self):
@@ -235,7 +456,11 @@ class ReadersCornerJSONItem(MultiDynamicContent):
         if not self.need_update():
             return []
         
+        bundle = self.metadata.get('bundle')
+        items = self.metadata.get('items', bundle is None)
+        
         rets = []
+        bundles = {}
         archives = self.data['readerscorner']
         for (year, yeararchive) in archives.items():
             for (month, montharchive) in yeararchive.items():
@@ -244,11 +469,50 @@ class ReadersCornerJSONItem(MultiDynamicContent):
                         entry = {}
                         for key in ['link', 'name', 'caption', 'description', 'message']:
                             entry[key] = item.get(key, '')
-                        self.data['entry'] = entry
-                        self.data['id'] = item['id']
-                        rets.extend(super(ReadersCornerJSONItem, self).render())
+                        if bundle is not None:
+                            bundles.setdefault(self.bundle_name(bundle, item), []).append((item['id'], entry))
+                        if items:
+                            self.data['entry'] = entry
+                            self.data['id'] = item['id']
+                            rets.extend(super(ReadersCornerJSONItem, self).render())
+        
+        if bundle is not None:
+            rets.extend(self.render_bundles(bundles))
         
         return rets
+    
+    def bundle_name(self, bundle, item):
+        if bundle == 'month':
+            return '%d-%02d' % (item['year'], item['month'])
+        return '%d' % (item['id'] // int(bundle))
+    
+    def render_bundles(self, bundles):
+        # Each bundle is a JSON list of entries, and is only regenerated when
+        # its own entries changed. The optional index maps every entry id to
+        # its bundle and its position in it.
+        rets = []
+        deps = self.without_slices()
+        lookup = {}
+        for name in sorted(bundles):
+            entries = sorted(bundles[name], key=lambda e: e[0])
+            for (offset, (id, entry)) in enumerate(entries):
+                lookup[id] = [name, offset]
+            text = json.dumps([entry for (id, entry) in entries]).replace('\\n', '<br>')
+            rets.append(self.write_bundle(self.app.url_for(self.metadata['bundleroute'], bundle=name), deps, text))
+        
+        if 'bundleindexroute' in self.metadata:
+            text = json.dumps(OrderedDict(('%d' % id, lookup[id]) for id in sorted(lookup)))
+            rets.append(self.write_bundle(self.app.url_for(self.metadata['bundleindexroute']), deps, text))
+        
+        return rets
+    
+    def write_bundle(self, url, dependencies, text):
+        path = self.app.get_output_path(url)
+        status = self.app.cache.need_update(path, dependencies, self.app.cache.fingerprint(text))
+        if status != 'Ignore' and not self.app.dry_run:
+            if not self.app.write_output(path, text):
+                status = 'Unchanged'
+        return (status, path)
 
 class BlogPost(DynamicContent):
     
@@ -273,15 +537,23 @@ class BlogPost(DynamicContent):
     def update(self, data):
         super(BlogPost, self).update(data)
     
-    def _render(self):
-        content = markdown(self.content)
-        
-        btemplate = ''
-        with open(self.app.get_path(self.data['template'], 'templates')) as f:
-            btemplate = f.read()
+    def render_body(self):
+        # The body only depends on its own text and the markdown settings, so
+        # rebuilds caused by templates or data reuse the cached html.
+        key = 'markdown:' + self.path
+        digest = self.app.cache.fingerprint([self.content, self.app.markdown])
+        cached = self.app.cache.get_value(key)
+        if cached is not None and cached['digest'] == digest:
+            return cached['html']
         
-        self.data['content'] = self.app.jinja_env.from_string(content).render()
-        return self.app.jinja_env.hamlish_from_string(btemplate)
+        content = markdown(self.content, **self.app.markdown)
+        html = self.app.jinja_env.from_string(content).render()
+        self.app.cache.put_value(key, {'digest': digest, 'html': html})
+        return html
+    
+    def _render(self):
+        self.data['content'] = self.render_body()
+        return self.app.load_template(self.data['template'])
 
 class Processor(object):
     
@@ -290,6 +562,20 @@ class Processor(object):
     
     def process(self, content):
         pass
+    
+    def files(self):
+        return []
+    
+    def types(self):
+        # Names of the content types whose metadata the processor reads, or
+        # None if it can't tell, in which case it is run on every build.
+        return None
+    
+    def inputs(self):
+        return []
+    
+    def outputs(self):
+        return []
 
 class TagList(Processor):
     
@@ -301,6 +587,12 @@ class TagList(Processor):
         self.route = route
         self.reverse = reverse
     
+    def types(self):
+        return ['BlogPost']
+    
+    def outputs(self):
+        return [self.key]
+    
     def process(self, content, data):
         
         lis = []
@@ -308,11 +600,14 @@ class TagList(Processor):
         for post in posts:
             lis.extend(post.metadata.get(self.key, []))
         
+        tagged = {}
+        for post in sorted((p.metadata for p in posts), reverse=self.reverse, key=lambda p: p[self.sortkey]):
+            for tag in set(post.get(self.datakey, [])):
+                tagged.setdefault(tag, []).append(post)
+        
         tags = []
         for (tag, count) in sorted(Counter(lis).items(), reverse=self.reverse, key=lambda k_v: (k_v[1], k_v[0])):
-            tagged = [p.metadata for p in posts if tag in p.metadata[self.datakey]]
-            tagged = sorted(tagged, reverse=self.reverse, key=lambda p: p[self.sortkey])
-            tags.append(OrderedDict([('tag',tag), ('count',count), ('posts', tagged), ('url', self.app.url_for(self.route, tag=tag))]))
+            tags.append(OrderedDict([('tag',tag), ('count',count), ('posts', tagged.get(tag, [])), ('url', self.app.url_for(self.route, tag=tag))]))
         
         data[self.key] = tags
         return data
@@ -326,6 +621,15 @@ class BlogSidebar(Processor):
         self.key = key
         self.routekey = routekey
     
+    def types(self):
+        return []
+    
+    def inputs(self):
+        return [self.routes, self.tags]
+    
+    def outputs(self):
+        return [self.key]
+    
     def process(self, content, data):
         
         sidebar = {
@@ -348,6 +652,17 @@ class PostList(Processor):
         self.filters = filters
         self.exclude = exclude
     
+    def types(self):
+        if self.filters is not None:
+            return None
+        return ['BlogPost']
+    
+    def inputs(self):
+        return [self.exclude]
+    
+    def outputs(self):
+        return [self.key]
+    
     def process(self, content, data):
         
         posts = [c.metadata for c in content if type(c) == BlogPost]
@@ -372,22 +687,24 @@ class PostArchives(Processor):
         self.key = key
         self.reverse = True
     
+    def types(self):
+        return ['BlogPost']
+    
+    def outputs(self):
+        return [self.key]
+    
     def process(self, content, data):
         
-        posts = [c for c in content if type(c) == BlogPost]
-        years = sorted(k for k in set(p.metadata['year'] for p in posts))
+        buckets = {}
+        for post in (c.metadata for c in content if type(c) == BlogPost):
+            buckets.setdefault(post['year'], {}).setdefault(post['month'], []).append(post)
         
         archives = OrderedDict()
         
-        for year in years:
+        for year in sorted(buckets):
             yeararchive = OrderedDict()
-            yearposts = [p for p in posts if p.metadata['year'] == year]
-            
-            months = sorted(k for k in set(p.metadata['month'] for p in yearposts))
-            for month in months:
-                monthposts = [p for p in yearposts if p.metadata['month'] == month]
-                monthposts = sorted(monthposts, reverse=self.reverse, key=lambda p: p.metadata['day'])
-                yeararchive[calendar.month_name[int(month)]] = [p.metadata for p in monthposts]
+            for month in sorted(buckets[year]):
+                yeararchive[calendar.month_name[int(month)]] = sorted(buckets[year][month], reverse=self.reverse, key=lambda p: p['day'])
             
             archives[year] = yeararchive
         
@@ -396,9 +713,15 @@ class PostArchives(Processor):
 
 class ReadersCorner(Processor):
     
-    def __init__(self, app, filename, filter=None, key='readerscorner', sidebarkey='readerscornersidebar', indexkey='readerscornerindex', route='readerscornerpge', homeroute='readerscornerhome', searchroute='readerscornersearch', stopwords=set(), reverse=True):
+    def __init__(self, app, filename, filter=None, key='readerscorner', sidebarkey='readerscornersidebar', indexkey='readerscornerindex', route='readerscornerpge', homeroute='readerscornerhome', searchroute='readerscornersearch', stopwords=set(), reverse=True, format=None, indexformat='json', indexroute='readerscornerindex', shardprefix=2):
         super(ReadersCorner, self).__init__(app)
         self.filename = filename
+        self.format = format
+        if self.format is None:
+            self.format = 'jsonl' if os.path.splitext(filename)[1] == '.jsonl' else 'json'
+        self.indexformat = indexformat
+        self.indexroute = indexroute
+        self.shardprefix = shardprefix
         self.filter = filter
         self.key = key
         self.indexkey = indexkey
@@ -409,27 +732,43 @@ class ReadersCorner(Processor):
         self.stopwords = stopwords
         self.reverse = True
     
+    def files(self):
+        return [self.filename]
+    
     def process(self, content, data):
 
         status, val = self.app.cache.get_file(self.filename)
-        if status == 'Cached':
+        if status == 'Cached' and self.reusable(val):
             data[self.key] = val[self.key]
             data[self.sidebarkey] = val[self.sidebarkey]
             data[self.indexkey] = val[self.indexkey]
             return data
 
-        source = []
-        with open(self.filename) as input:
-            source = json.load(input)
-
         words = {}
         eid = 0
+        position = 0
+        etable = {}
+        entries = []
+        index = OrderedDict()
+        shards = []
+        
+        previous = self.app.cache.get_value(self.filename)
+        if self.can_resume(previous):
+            position = previous['position']
+            eid = previous['count']
+            entries = sorted((e for y in previous[self.key].values() for m in y.values() for d in m.values() for e in d), key=lambda e: e['id'])
+            etable = dict((e['id'], e) for e in entries)
+            if self.indexformat == 'sharded':
+                shards = previous[self.indexkey]['shards']
+            else:
+                index = json.loads(previous[self.indexkey], object_pairs_hook=OrderedDict)
+            if self.app.verbose:
+                print('Resuming %s after %d entries' % (self.filename, len(entries)))
+        
         patternapos = re.compile("'")
         patternspace = re.compile('_|-')
         patternalnum = re.compile(r'\W+')
-        etable = {}
-        entries = []
-        for entry in source:
+        for entry in self.read_entries(position):
             if self.filter is not None:
                 entry = self.filter(entry)
                 if entry is None:
@@ -461,12 +800,127 @@ class ReadersCorner(Processor):
             eid = eid + 1
             entries.append(entry)
 
-        _index = OrderedDict()
-        for word, results in sorted(words.items(), key = lambda wr: wr[0]):
-            _index[word] = sorted([r for r in results], key = lambda r: etable[r]['created_time'], reverse = self.reverse)
-        index = json.dumps(_index)
+        if self.indexformat == 'sharded':
+            index = self.write_shards(words, shards)
+        else:
+            for (word, results) in words.items():
+                results.update(index.get(word, []))
+                index[word] = sorted(sorted(results), key = lambda r: etable[r]['created_time'], reverse = self.reverse)
+            _index = OrderedDict((word, index[word]) for word in sorted(index))
+            index = json.dumps(_index)
+        
+        archives, sidebar = self.build_archives(entries)
+
+        data[self.key] = archives
+        data[self.sidebarkey] = sidebar
+        data[self.indexkey] = index
+        self.app.cache.put_file(self.filename, {self.key : archives, self.sidebarkey : sidebar, self.indexkey : index, 'position' : self.position, 'count' : eid, 'checksum' : self.checksum(self.position), 'indexformat' : self.indexformat, 'shardprefix' : self.shardprefix})
+
+        return data
+    
+    def checksum(self, position):
+        if self.format != 'jsonl':
+            return None
+        with open(self.filename, 'rb') as f:
+            f.seek(max(0, position - 4096))
+            return hashlib.sha1(f.read(min(position, 4096))).hexdigest()
+    
+    def reusable(self, previous):
+        # Whether a cached result was built with the same index settings, and
+        # in sharded mode whether its shards are all still on disk.
+        if previous is None or previous.get('indexformat') != self.indexformat:
+            return False
+        index = previous.get(self.indexkey)
+        if self.indexformat == 'sharded':
+            if not isinstance(index, Mapping) or previous.get('shardprefix') != self.shardprefix:
+                return False
+            return all(os.path.exists(self.shard_path(name)) for name in index['shards'])
+        return isinstance(index, (str, type(u'')))
+    
+    def can_resume(self, previous):
+        if self.format != 'jsonl' or previous is None or previous.get('position') is None:
+            return False
+        if os.path.getsize(self.filename) < previous['position']:
+            return False
+        if not self.reusable(previous):
+            return False
+        return self.checksum(previous['position']) == previous['checksum']
+    
+    def shard_path(self, name):
+        return self.app.get_output_path(self.app.url_for(self.indexroute, shard=name))
+    
+    def write_shards(self, words, previous):
+        shards = {}
+        for (word, results) in words.items():
+            shards.setdefault(word[:self.shardprefix], {})[word] = results
         
-        years = sorted((k for k in set(e['year'] for e in entries)), reverse=self.reverse)
+        for (name, shard) in shards.items():
+            path = self.shard_path(name)
+            if name in previous:
+                with open(path) as f:
+                    for (word, deltas) in json.load(f).items():
+                        ids = []
+                        for delta in deltas:
+                            ids.append(delta + (ids[-1] if ids else 0))
+                        shard.setdefault(word, set()).update(ids)
+            
+            encoded = OrderedDict()
+            for word in sorted(shard):
+                ids = sorted(shard[word])
+                encoded[word] = ids[:1] + [b - a for (a, b) in zip(ids, ids[1:])]
+            text = json.dumps(encoded, separators=(',', ':'))
+            
+            status = self.app.cache.need_update(path, [], self.app.cache.fingerprint(text))
+            if status != 'Ignore' and not self.app.dry_run:
+                if not self.app.write_output(path, text):
+                    status = 'Unchanged'
+            if status != 'Ignore' or self.app.verbose:
+                print('[%s] %s' % (status, path))
+        
+        names = sorted(set(previous) | set(shards))
+        return OrderedDict([('format', 'sharded'), ('prefix', self.shardprefix), ('shards', OrderedDict((name, self.app.url_for(self.indexroute, shard=name)) for name in names))])
+    
+    def read_entries(self, position=0):
+        self.position = position
+        if self.format == 'jsonl':
+            with open(self.filename, 'rb') as f:
+                f.seek(position)
+                for line in f:
+                    self.position += len(line)
+                    line = line.strip()
+                    if line:
+                        yield json.loads(line.decode('utf-8'))
+            return
+        
+        decoder = json.JSONDecoder()
+        with open(self.filename) as f:
+            buf = f.read(65536).lstrip()
+            if not buf.startswith('['):
+                raise ValueError('%s does not contain a JSON array' % self.filename)
+            pos = 1
+            eof = False
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buf) and buf[pos] == ']':
+                    return
+                try:
+                    entry, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                    chunk = f.read(65536)
+                    eof = not chunk
+                    buf = buf[pos:] + chunk
+                    pos = 0
+                    continue
+                pos = end
+                yield entry
+    
+    def build_archives(self, entries):
+        buckets = {}
+        for e in entries:
+            buckets.setdefault(e['year'], {}).setdefault(e['month'], {}).setdefault(e['day'], []).append(e)
 
         archives = OrderedDict()
         sidebar = OrderedDict()
@@ -475,31 +929,21 @@ class ReadersCorner(Processor):
         sidebar['Main']['Home'] = self.app.url_for(self.homeroute)
         sidebar['Main']['Search'] = self.app.url_for(self.searchroute)
         
-        for year in years:
+        for year in sorted(buckets, reverse=self.reverse):
             yeararchive = OrderedDict()
             sidebar[year] = OrderedDict()
-            yearentries = [e for e in entries if e['year'] == year]
             
-            months = sorted((k for k in set(e['month'] for e in yearentries)), reverse=self.reverse)
-            for month in months:
+            for month in sorted(buckets[year], reverse=self.reverse):
                 montharchive = OrderedDict()
-                monthentries = [e for e in yearentries if e['month'] == month]
-                days = sorted((k for k in set(e['day'] for e in monthentries)), reverse=self.reverse)
-                for day in days:
-                    dayentries = [e for e in monthentries if e['day'] == day]
-                    montharchive[day] = sorted(dayentries, reverse=self.reverse, key=lambda e: e['timestamp'])
+                for day in sorted(buckets[year][month], reverse=self.reverse):
+                    montharchive[day] = sorted(buckets[year][month][day], reverse=self.reverse, key=lambda e: e['timestamp'])
                 yeararchive[month] = montharchive
                 linkstring = '%s (%s)' % (calendar.month_name[int(month)], sum(len(v) for k,v in montharchive.items()))
                 sidebar[year][linkstring] = self.app.url_for(self.route, year=year, month=month)
             
             archives[year] = yeararchive
-
-        data[self.key] = archives
-        data[self.sidebarkey] = sidebar
-        data[self.indexkey] = index
-        self.app.cache.put_file(self.filename, {self.key : archives, self.sidebarkey : sidebar, self.indexkey : index})
-
-        return data
+        
+        return (archives, sidebar)
 
 class RSSFeed(Processor):
     
@@ -513,6 +957,12 @@ class RSSFeed(Processor):
         self.sortkey = sortkey
         self.reverse = True
     
+    def types(self):
+        return ['BlogPost']
+    
+    def outputs(self):
+        return [self.key]
+    
     def process(self, content, data):
         
         posts = [c for c in content if type(c) == BlogPost]
@@ -534,6 +984,12 @@ class Sitemap(Processor):
         self.key = key
         self.root = root
     
+    def types(self):
+        return sorted(set(type(c).__name__ for c in self.app.content) - set(['TagPage', 'StaticContent', 'ReadersCornerPage', 'ReadersCornerJSONItem']))
+    
+    def outputs(self):
+        return [self.key]
+    
     def process(self, content, data):
         
         urls = []
@@ -546,9 +1002,12 @@ class Sitemap(Processor):
 
 class CacheDict(MutableMapping):
 
+    suffix = ''
+
     def __init__(self, path, *args, **kwargs):
         self.store = dict()
         self.path = path
+        self.modified = False
 
         if os.path.exists(path):
             self.store.update(json.loads(open(path).read()))
@@ -560,9 +1019,11 @@ class CacheDict(MutableMapping):
 
     def __setitem__(self, key, value):
         self.store[key] = value
+        self.modified = True
 
     def __delitem__(self, key):
         del self.store[key]
+        self.modified = True
 
     def __iter__(self):
         return iter(self.store)
@@ -571,15 +1032,160 @@ class CacheDict(MutableMapping):
         return len(self.store)
 
     def close(self):
-        with open(self.path, 'w') as output:
-            output.write(json.dumps(self.store))
+        if not self.modified and os.path.exists(self.path):
+            return
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as output:
+            output.write(json.dumps(self.store, default=_encode))
+        getattr(os, 'replace', os.rename)(tmp, self.path)
+        self.modified = False
+
+class SqliteCacheDict(MutableMapping):
+
+    suffix = '.db'
+
+    def __init__(self, path, *args, **kwargs):
+        self.store = dict()
+        self.path = path
+        self.dirty = set()
+        self.deleted = set()
+        self.db = None
+        self.keys = set(k for (k,) in self.connection().execute('SELECT key FROM cache'))
+
+        self.update(dict(*args, **kwargs))
+
+    def connection(self):
+        if self.db is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.db = sqlite3.connect(self.path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)')
+        return self.db
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __getitem__(self, key):
+        if key in self.store:
+            return self.store[key]
+        if key not in self.keys:
+            raise KeyError(key)
+        (value,) = self.connection().execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+        self.store[key] = json.loads(value)
+        return self.store[key]
+
+    def __setitem__(self, key, value):
+        self.store[key] = value
+        self.keys.add(key)
+        self.dirty.add(key)
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self.keys:
+            raise KeyError(key)
+        self.store.pop(key, None)
+        self.keys.discard(key)
+        self.dirty.discard(key)
+        self.deleted.add(key)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        db = self.connection()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)', ((k, json.dumps(self.store[k], default=_encode)) for k in self.dirty))
+            db.executemany('DELETE FROM cache WHERE key = ?', ((k,) for k in self.deleted))
+        db.close()
+        self.db = None
+        self.dirty = set()
+        self.deleted = set()
 
 class Cache(object):
     
-    def __init__(self, path):
-        self.store = CacheDict(path)
-        self.updated_content = []
+    stores = {'json': CacheDict, 'sqlite': SqliteCacheDict}
+    
+    def __init__(self, path, digests=False, store='json', profiler=None):
+        self.backend = self.stores[store]
+        self.path = path + self.backend.suffix
+        self.store = self.backend(self.path)
+        self.digests = digests
+        self.profiler = Profiler()
+        if profiler is not None:
+            self.profiler = profiler
+        self.updated_content = set()
+        self.updated_keys = set()
         self.mtimes = {}
+        self.fingerprints = {}
+        self.stats = {}
+        self.journal = None
+    
+    def set(self, key, val):
+        self.store[key] = val
+        self.mtimes[key] = val['mtime']
+        if self.journal is not None:
+            self.journal[key] = val
+    
+    def begin(self):
+        self.journal = {}
+    
+    def end(self):
+        journal, self.journal = self.journal, None
+        return journal
+    
+    def merge(self, journal):
+        for (key, val) in journal.items():
+            self.store[key] = val
+            self.mtimes[key] = val['mtime']
+    
+    def stat(self, path):
+        st = self.stats.get(path)
+        if st is None:
+            st = os.stat(path)
+        return [st.st_size, st.st_mtime, st.st_ino]
+    
+    def unchanged(self, path):
+        # whether get_file would return the cached value without reading
+        val = self.store.get(path)
+        if val is None:
+            return False
+        if self.digests:
+            return val.get('stat') == self.stat(path)
+        return self.stat(path)[1] < val['mtime']
+    
+    def digest(self, path):
+        if path in self.fingerprints:
+            return self.fingerprints[path]
+        
+        digest = None
+        if os.path.isfile(path):
+            h = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    h.update(chunk)
+            digest = h.hexdigest()
+        self.fingerprints[path] = digest
+        return digest
+    
+    def identity(self, path):
+        # what changes whenever the cached metadata of a source does
+        val = self.store.get(path)
+        if val is None:
+            return None
+        if self.digests:
+            return val.get('digest')
+        return val['mtime']
+    
+    def source_digest(self, path):
+        val = self.store.get(path)
+        if self.digests and val is not None and 'digest' in val:
+            return val['digest']
+        return self.fingerprint(self.stat(path))
+    
+    def fingerprint(self, value):
+        return hashlib.sha1(json.dumps(value, default=_encode).encode('utf-8')).hexdigest()
     
     def get_file(self, path):
         val = None
@@ -587,41 +1193,101 @@ class Cache(object):
         
         key = path
         if key not in self.store:
+            self.profiler.count('cache.get_file.Read')
             return (status, val)
         
-        mtime = os.path.getmtime(path)
         val = self.store[key]
         
-        if mtime < val['mtime']:
+        if self.digests:
+            stat = self.stat(path)
+            if val.get('stat') == stat:
+                status = 'Cached'
+            elif val.get('digest') is not None and val['digest'] == self.digest(path):
+                val['stat'] = stat
+                self.set(key, val)
+                status = 'Cached'
+        elif self.stat(path)[1] < val['mtime']:
             status = 'Cached'
+        
+        if status == 'Cached':
             val = val['value']
 
         if status == 'Read':
-            self.updated_content.append(path)
+            self.updated_content.add(path)
         
+        self.profiler.count('cache.get_file.' + status)
         return (status, val)
     
+    def get_value(self, key):
+        if key not in self.store:
+            return None
+        return self.store[key]['value']
+    
     def put_file(self, path, value):
         key = path
         val = {'mtime': int(time.time()), 'value': value}
-        
-        self.store[key] = val
-        self.mtimes[path] = val['mtime']
+        if self.digests:
+            val['stat'] = self.stat(path)
+            val['digest'] = self.digest(path)
+        self.set(key, val)
 
+    def put_value(self, key, value):
+        self.set(key, {'mtime': int(time.time()), 'value': value})
+    
     def put_content(self, name, value):
+        # Only a digest of the value is kept, which is all that is needed to
+        # tell whether it changed.
         key = name
-        val = {'mtime': int(time.time()), 'value': value}
+        val = {'mtime': int(time.time()), 'value': None, 'digest': self.fingerprint(value)}
         
-        v = self.store.get(key, {'value': None})
-        if v['value'] != value:
-            self.store[key] = val
-            self.updated_content.append(name)
-            self.mtimes[name] = val['mtime']
+        v = self.store.get(key, {'digest': None})
+        if v.get('digest') != val['digest']:
+            self.set(key, val)
+            self.updated_content.add(name)
+            self.updated_keys.add(name)
+    
+    def need_update(self, path, dependencies=None, fingerprint=None):
+        if self.digests:
+            fingerprint = self.dependency_fingerprint(dependencies, fingerprint)
+        
+        status = self.check_output(path, dependencies, fingerprint)
+        if status != 'Ignore' and fingerprint is not None:
+            # keeps the output digest put_output stored, so identical output
+            # is still recognised
+            val = dict(self.store.get(path, {}))
+            val['mtime'] = int(time.time())
+            val['value'] = fingerprint
+            self.set(path, val)
+        self.profiler.count('cache.need_update.' + status)
+        return status
     
-    def need_update(self, path, dependencies=None):
+    def check_output(self, path, dependencies=None, fingerprint=None):
         if not os.path.exists(path):
             return 'Create'
-        mtime = os.path.getmtime(path)
+        # an output left alone because it came out identical still counts as
+        # generated at the time it was checked
+        if not self.digests and self.modified_since(max(os.path.getmtime(path), self.store.get(path, {'mtime': 0})['mtime']), dependencies):
+            return 'Modified'
+        if fingerprint is not None and self.store.get(path, {'value': None})['value'] != fingerprint:
+            return 'Modified'
+        return 'Ignore'
+    
+    def same_output(self, path, digest, size):
+        val = self.store.get(path)
+        if val is None or val.get('output') != digest:
+            return False
+        try:
+            return os.path.getsize(path) == size
+        except OSError:
+            return False
+    
+    def put_output(self, path, digest):
+        val = dict(self.store.get(path, {'value': None}))
+        val['mtime'] = int(time.time())
+        val['output'] = digest
+        self.set(path, val)
+    
+    def modified_since(self, mtime, dependencies=None):
         
         deps = []
         if dependencies is not None:
@@ -636,102 +1302,542 @@ class Cache(object):
                 self.mtimes[dep] = mtimes[-1]
         
         if mtime < max(mtimes):
-            return 'Modified'
+            return True
 
-        for dep in dependencies:
+        for dep in deps:
             if dep in self.updated_content:
-                return 'Modified'
+                return True
 
-        return 'Ignore'
+        return False
+    
+    def dependency_fingerprint(self, dependencies=None, fingerprint=None):
+        digests = [fingerprint]
+        for dep in (dependencies or []):
+            val = self.store.get(dep)
+            if val is not None and 'digest' in val:
+                digests.append(val['digest'])
+            else:
+                digests.append(self.digest(dep))
+        return self.fingerprint(digests)
+    
+    def reset(self):
+        self.updated_content = set()
+        self.updated_keys = set()
+        self.mtimes = {}
+        self.fingerprints = {}
+        self.stats = {}
+    
+    def sync(self):
+        self.store.close()
+    
+    def discard(self):
+        # drops everything recorded since the last sync
+        self.store = self.backend(self.path)
+        self.reset()
     
     def shutdown(self):
         self.store.close()
 
+class DependencyGraph(object):
+    
+    def __init__(self):
+        self.dependencies = {}
+        self.dependents = {}
+    
+    def add(self, node, dependencies):
+        self.dependencies[node] = set(dependencies)
+        for dep in dependencies:
+            self.dependents.setdefault(dep, set()).add(node)
+    
+    def dirty(self, updated):
+        dirty = set()
+        pending = list(updated)
+        while pending:
+            for node in self.dependents.get(pending.pop(), ()):
+                if node not in dirty:
+                    dirty.add(node)
+                    pending.append(node)
+        return dirty
+
+class Span(object):
+    
+    def __init__(self, profiler, category, name, args):
+        self.profiler = profiler
+        self.category = category
+        self.name = name
+        self.args = args
+    
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    
+    def __exit__(self, *exc):
+        self.profiler.record(self.category, self.name, self.start, time.time(), self.args)
+        return False
+
+class Profiler(object):
+    
+    # Collects timed spans and counters for a build. When disabled every call
+    # is a no-op, so instrumentation can stay in place unconditionally.
+    
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.origin = time.time()
+        self.events = []
+        self.counters = Counter()
+        self.noop = Span(self, None, None, None)
+    
+    def span(self, category, name, **args):
+        if not self.enabled:
+            return self.noop
+        return Span(self, category, name, args)
+    
+    def record(self, category, name, start, end, args):
+        if self.enabled:
+            self.events.append({'cat': category, 'name': name, 'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6, 'pid': os.getpid(), 'args': args})
+    
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+    
+    def written(self, path):
+        if self.enabled:
+            self.counters['bytes written'] += os.path.getsize(path)
+            self.counters['files written'] += 1
+    
+    def begin(self):
+        self.events = []
+        self.counters = Counter()
+    
+    def end(self):
+        return (self.events, self.counters)
+    
+    def merge(self, profile):
+        events, counters = profile
+        self.events.extend(events)
+        self.counters.update(counters)
+    
+    def summary(self):
+        totals = lambda: OrderedDict([('count', 0), ('time', 0.0)])
+        report = OrderedDict((section, {}) for section in ['stages', 'types', 'files', 'processors', 'templates'])
+        for event in self.events:
+            seconds = event['dur'] / 1e6
+            category = event['cat']
+            if category == 'stage':
+                entries = [report['stages'].setdefault(event['name'], totals())]
+            elif category == 'process':
+                entries = [report['processors'].setdefault(event['name'], totals())]
+            elif category in ('compile', 'template'):
+                entries = [report['templates'].setdefault(event['name'], OrderedDict()).setdefault(category, totals())]
+            else:
+                entries = [report['types'].setdefault(event['args']['type'], OrderedDict()).setdefault(category, totals()),
+                           report['files'].setdefault(event['name'], OrderedDict()).setdefault(category, totals())]
+            for entry in entries:
+                entry['count'] += 1
+                entry['time'] += seconds
+        
+        for section in ['types', 'files', 'processors', 'templates']:
+            report[section] = OrderedDict(sorted(report[section].items()))
+        report['counters'] = OrderedDict(sorted(self.counters.items()))
+        return report
+    
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+    
+    def save_trace(self, path):
+        events = [{'name': e['name'], 'cat': e['cat'], 'ph': 'X', 'ts': e['ts'], 'dur': e['dur'], 'pid': e['pid'], 'tid': e['pid'], 'args': e['args']} for e in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
 class Engine(object):
     
-    def __init__(self, directories, routes, sources, processors, data, verbose=False):
+    # ways of putting static files in place, each tried in turn before
+    # falling back to a plain copy
+    statics = OrderedDict([('copy', []), ('hardlink', [_hardlink]), ('reflink', [_reflink, _copy_range]), ('kernel', [_copy_range])])
+    
+    def __init__(self, directories, routes, sources, processors, data, verbose=False, workers=1, digests=False, store='json', dry_run=False, lowmem=False, batch=64, markdown=None, profiler=None, static='copy', readers=8, stream=False, buffer=65536):
         self.directories = directories
         self.routes = routes
         self.sources = sources
         self.processors = processors
         self.data = data
         self.verbose = verbose
+        self.workers = workers
+        self.dry_run = dry_run
+        self.lowmem = lowmem
+        self.batch = batch
+        self.static = static
+        self.readers = readers
+        self.stream = stream
+        self.buffer = buffer
+        self.listings = {}
+        self.headers = {}
+        self.unsupported = set()
+        self.created = set()
+        self.output_paths = {}
+        self.compile_routes()
+        self.markdown = {}
+        if markdown is not None:
+            self.markdown = markdown
         
-        self.content = []
-        self.cache = Cache('cache')
-        
-        self.jinja_env = Environment(extensions=['jinja2.ext.autoescape', 'jinja2.ext.with_', 'hamlish_jinja.HamlishExtension'])
-        self.jinja_env.loader = FileSystemLoader(self.directories['templates'])
-        self.jinja_env.hamlish_enable_div_shortcut = True
-        self.jinja_env.hamlish_mode = 'debug'
-        self.jinja_env.hamlish_file_extensions=('.haml','.xml')
+        self.profiler = Profiler()
+        if profiler is not None:
+            self.profiler = profiler
         
+        self.content = []
+        self.graph = DependencyGraph()
+        self.dirty = set()
+        self.cache = Cache('cache', digests, store, self.profiler)
+        self.jinja_env = self.create_jinja_env()
+        self.templates = {}
+        self.template_sources = {}
+        self.load_templates()
+    
+    def load_templates(self):
         for path in glob.glob(self.directories['templates'] + os.sep + '*'):
             status, val = self.cache.get_file(path)
             if status != 'Cached':
                 self.cache.put_file(path, '')
 
+    def create_jinja_env(self):
+        jinja_env = Environment(extensions=['jinja2.ext.autoescape', 'jinja2.ext.with_', 'hamlish_jinja.HamlishExtension'])
+        jinja_env.loader = FileSystemLoader(self.directories['templates'])
+        jinja_env.hamlish_enable_div_shortcut = True
+        jinja_env.hamlish_mode = 'debug'
+        jinja_env.hamlish_file_extensions=('.haml','.xml')
+        if 'bytecode' in self.directories:
+            if not os.path.exists(self.directories['bytecode']):
+                os.makedirs(self.directories['bytecode'])
+            jinja_env.bytecode_cache = FileSystemBytecodeCache(self.directories['bytecode'])
+        return jinja_env
+    
+    def compile_template(self, source, label=None):
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        if key in self.templates:
+            self.profiler.count('templates.memoized')
+            return self.templates[key]
+        
+        env = self.jinja_env
+        name = 'hamlish_from_string' + env.hamlish_file_extensions[0]
+        bucket = None
+        code = None
+        with self.profiler.span('compile', label or key):
+            if env.bytecode_cache is not None:
+                bucket = env.bytecode_cache.get_bucket(env, name, key, source)
+                code = bucket.code
+            if code is None:
+                code = env.compile(source, name)
+                self.profiler.count('templates.compiled')
+                if bucket is not None:
+                    bucket.code = code
+                    env.bytecode_cache.set_bucket(bucket)
+            else:
+                self.profiler.count('templates.bytecode')
+            
+            template = env.template_class.from_code(env, code, env.make_globals(None), None)
+        self.templates[key] = template
+        return template
+    
+    def load_template(self, name):
+        if name not in self.template_sources:
+            with open(self.get_path(name, 'templates')) as f:
+                self.template_sources[name] = f.read()
+        return self.compile_template(self.template_sources[name], name)
+
     def get_path(self, path, resource=None):
         if resource is not None:
             return os.path.join(self.directories[resource], path)
         return path
     
     def get_output_path(self, path, static=False):
-        (root, ext) = os.path.splitext(path)
-        root = (self.directories['output'] + os.sep + root).replace('%s%s' % (os.sep, os.sep), os.sep)
-        if ext == '':
-            ext = os.sep + 'index.html'
-        if os.path.basename(path) != '':
-            root, tmp = os.path.split(root)
-            ext = tmp + ext
-            root = root + os.sep
-        if not os.path.exists(root):
-            os.makedirs(root)
-        return (root + ext).replace('%s%s' % (os.sep, os.sep), os.sep)
+        if path in self.output_paths:
+            (root, output) = self.output_paths[path]
+        else:
+            (root, ext) = os.path.splitext(path)
+            root = (self.directories['output'] + os.sep + root).replace('%s%s' % (os.sep, os.sep), os.sep)
+            if ext == '':
+                ext = os.sep + 'index.html'
+            if os.path.basename(path) != '':
+                root, tmp = os.path.split(root)
+                ext = tmp + ext
+                root = root + os.sep
+            output = (root + ext).replace('%s%s' % (os.sep, os.sep), os.sep)
+            self.output_paths[path] = (root, output)
+        if root not in self.created and not self.dry_run:
+            self.make_directory(root)
+        return output
+    
+    def write_output(self, path, text):
+        # Returns False when the output already held exactly this text, in
+        # which case the file is left untouched.
+        data = text.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        written = not self.cache.same_output(path, digest, len(data))
+        if written:
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            try:
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                getattr(os, 'replace', os.rename)(tmp, path)
+            except BaseException:
+                self.remove_temporary(tmp)
+                raise
+            self.profiler.written(path)
+        else:
+            self.profiler.count('files unchanged')
+        self.cache.put_output(path, digest)
+        return written
+    
+    def remove_temporary(self, tmp):
+        # drops what a failed write left behind, if anything
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+    
+    def make_directory(self, root):
+        # remembers every directory made or found, so each is checked once
+        if not os.path.isdir(root):
+            try:
+                os.makedirs(root)
+            except OSError:
+                if not os.path.isdir(root):
+                    raise
+        self.created.add(root)
+    
+    def copy_file(self, source, target):
+        for method in self.statics[self.static]:
+            if method in self.unsupported:
+                continue
+            try:
+                return method(source, target)
+            except (OSError, IOError):
+                self.unsupported.add(method)
+                if os.path.exists(target):
+                    os.remove(target)
+        shutil.copy(source, target)
+    
+    def stream_output(self, path, chunks):
+        # Like write_output, but writes the text as it is produced so the
+        # whole of it is never held in memory. Whether it changed is only
+        # known at the end, when the temporary file is dropped if it didn't.
+        h = hashlib.sha1()
+        size = 0
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp, 'wb', self.buffer) as f:
+                for chunk in chunks:
+                    data = chunk.encode('utf-8')
+                    h.update(data)
+                    size += len(data)
+                    f.write(data)
+            digest = h.hexdigest()
+            written = not self.cache.same_output(path, digest, size)
+            if written:
+                getattr(os, 'replace', os.rename)(tmp, path)
+            else:
+                os.remove(tmp)
+        except BaseException:
+            self.remove_temporary(tmp)
+            raise
+        if written:
+            self.profiler.written(path)
+        else:
+            self.profiler.count('files unchanged')
+        self.cache.put_output(path, digest)
+        return written
+    
+    def copy_output(self, source, path):
+        digest = self.cache.source_digest(source)
+        written = not self.cache.same_output(path, digest, os.path.getsize(source))
+        if written:
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            try:
+                self.copy_file(source, tmp)
+                getattr(os, 'replace', os.rename)(tmp, path)
+            except BaseException:
+                self.remove_temporary(tmp)
+                raise
+            self.profiler.written(path)
+        else:
+            self.profiler.count('files unchanged')
+        self.cache.put_output(path, digest)
+        return written
+    
+    def compile_routes(self):
+        # Records which fields each route uses, so urls can be memoized on
+        # just those values rather than formatted on every call.
+        self.route_fields = {}
+        for (name, route) in self.routes.items():
+            fields = set(re.split(r'[.\[]', field)[0] for (text, field, spec, conversion) in string.Formatter().parse(route) if field)
+            self.route_fields[name] = tuple(sorted(fields))
+        self.urls = {}
     
     def url_for(self, route, **kwargs):
-        return self.routes[route].format(**kwargs)
+        fields = self.route_fields.get(route)
+        if fields is None:
+            return self.routes[route].format(**kwargs)
+        try:
+            key = (route,) + tuple(kwargs[field] for field in fields)
+            url = self.urls.get(key)
+        except (KeyError, TypeError):
+            return self.routes[route].format(**kwargs)
+        if url is None:
+            url = self.urls[key] = self.routes[route].format(**kwargs)
+        return url
 
-    def load_content(self):
+    def url_from(self, data):
+        # Like url_for, but picks only the route's fields out of a (possibly
+        # large) mapping instead of unpacking all of it.
+        fields = self.route_fields.get(data['route'])
+        if fields is None:
+            return self.url_for(**data)
+        return self.url_for(data['route'], **dict((field, data[field]) for field in fields if field != 'route' and field in data))
+
+    def load_content(self, changed=None):
         print('Loading content ...')
         count = 0
         cached = 0
         start = time.time()
-        for type, expr, mappings, dependencies in self.sources:
+        
+        loaded = {}
+        if changed is not None:
+            loaded = dict(((c.source, c.path), c) for c in self.content)
+        
+        self.listings = {}
+        found = []
+        pending = []
+        for (source, (type, expr, mappings, dependencies)) in enumerate(self.sources):
             cons = getattr(sys.modules[__name__], type)
-            for path in [p for p in glob.glob(expr) if not os.path.isdir(p)]:
-                item = cons(self, path, mappings, dependencies)
-                status = item.load()
-                if status != 'Cached' or self.verbose:
-                    print('[%s] %s' % (status, path))
-                else:
-                    cached += 1
-                self.content.append(item)
-                count += 1
+            for path in self.discover(expr):
+                found.append((source, type, cons, mappings, dependencies, path))
+                if issubclass(cons, DynamicContent) and ((source, path) not in loaded or path in changed) and not self.cache.unchanged(path):
+                    pending.append(path)
+        
+        # front matter that has to be parsed is read ahead on a few threads,
+        # which mostly helps when the files are on slow or remote storage
+        self.headers = {}
+        if self.readers > 1 and len(pending) > 1:
+            pool = multiprocessing.pool.ThreadPool(min(self.readers, len(pending)))
+            try:
+                self.headers = dict(zip(pending, pool.map(_read_header, [self.get_path(p) for p in pending])))
+            finally:
+                pool.close()
+                pool.join()
+        
+        content = []
+        for (source, type, cons, mappings, dependencies, path) in found:
+            item = loaded.get((source, path))
+            if item is None or path in changed:
+                with self.profiler.span('load', path, type=type):
+                    item = cons(self, path, mappings, dependencies)
+                    item.source = source
+                    status = item.load()
+            else:
+                status = 'Cached'
+            if status != 'Cached' or self.verbose:
+                print('[%s] %s' % (status, path))
+            else:
+                cached += 1
+            content.append(item)
+            count += 1
+        self.content = content
+        self.headers = {}
         print('Loaded {} items ({} cached) in {:.2f}s.'.format(count, cached, time.time()-start))
     
+    def discover(self, expr):
+        # Lists the files matching expr like glob does, but reads each
+        # directory once and keeps the stat results for the cache.
+        (directory, pattern) = os.path.split(expr)
+        if not hasattr(os, 'scandir') or glob.has_magic(directory) or not glob.has_magic(pattern):
+            return [p for p in glob.glob(expr) if not os.path.isdir(p)]
+        
+        if directory not in self.listings:
+            entries = []
+            try:
+                for entry in os.scandir(directory or os.curdir):
+                    try:
+                        if not entry.is_dir():
+                            entries.append((entry.name, entry.stat()))
+                    except OSError:
+                        entries.append((entry.name, None))
+            except OSError:
+                pass
+            self.listings[directory] = entries
+        
+        paths = []
+        for (name, st) in self.listings[directory]:
+            if fnmatch.fnmatch(name, pattern) and (pattern.startswith('.') or not name.startswith('.')):
+                path = os.path.join(directory, name)
+                if st is not None:
+                    self.cache.stats[path] = st
+                paths.append(path)
+        return paths
+    
     def process_content(self):
         print('Processing content ...')
         start = time.time()
         count = 0
-        for (type, kwargs) in self.processors:
-            if self.verbose:
-                print('Processing %s' % type)
+        skipped = 0
+        sources = {}
+        for content in self.content:
+            sources.setdefault(content.__class__.__name__, []).append([content.path, self.cache.identity(content.path)])
+        for (index, (type, kwargs)) in enumerate(self.processors):
             processor = getattr(sys.modules[__name__], type)(self, **kwargs)
-            self.data.update(processor.process(self.content, self.data))
+            key = 'processor:%d:%s' % (index, type)
+            digest = self.processor_digest(processor, type, kwargs, sources)
+            cached = self.cache.get_value(key)
+            if digest is not None and cached is not None and cached['digest'] == digest:
+                if self.verbose:
+                    print('[Skipped] %s' % type)
+                self.data.update(cached['outputs'])
+                skipped += 1
+            else:
+                if self.verbose:
+                    print('Processing %s' % type)
+                with self.profiler.span('process', type):
+                    self.data.update(processor.process(self.content, self.data))
+                if digest is not None:
+                    self.cache.put_value(key, {'digest': digest, 'outputs': dict((k, self.data.get(k)) for k in processor.outputs())})
             count += 1
         for key,val in self.data.items():
             self.cache.put_content(key, val)
-        print('Ran {} processors in {:.2f}s.'.format(count, time.time()-start))
+        print('Ran {} processors ({} skipped) in {:.2f}s.'.format(count, skipped, time.time()-start))
+    
+    def processor_digest(self, processor, type, kwargs, sources):
+        # Fingerprints everything a processor declares it reads, or returns
+        # None if it doesn't declare that or its settings can't be hashed.
+        types = processor.types()
+        if types is None:
+            return None
+        try:
+            return self.cache.fingerprint([type, kwargs, self.routes, self.directories['output'],
+                                           [sources.get(t, []) for t in types],
+                                           [self.data.get(k) for k in processor.inputs()],
+                                           [self.cache.source_digest(p) for p in processor.files()]])
+        except TypeError:
+            return None
+    
+    def plan(self):
+        self.graph = DependencyGraph()
+        for content in self.content:
+            self.graph.add(content, content.depends())
+        self.dirty = self.graph.dirty(self.cache.updated_content)
+        
+        if self.dry_run or self.verbose:
+            for key in sorted(self.cache.updated_keys):
+                print('[Changed] %s' % key)
+            for content in self.content:
+                if content in self.dirty:
+                    print('[Dirty] %s' % content.path)
     
     def generate_output(self):
+        self.plan()
         print('Generating output ...')
         count = 0
         cached = 0
         start = time.time()
-        for content in self.content:
-            content.update(self.data)
-            for (status, path) in content.render():
+        for rets in self.render_content():
+            for (status, path) in rets:
                 if status != 'Ignore' or self.verbose:
                     print('[%s] %s' % (status, path))
                 else:
@@ -739,14 +1845,244 @@ class Engine(object):
                 count += 1
         print('Generated {} items ({} cached) in {:.2f}s.'.format(count, cached, time.time()-start))
     
+    def render_item(self, index):
+        content = self.content[index]
+        type = content.__class__.__name__
+        with self.profiler.span('update', content.path, type=type):
+            content.update(self.data)
+        with self.profiler.span('render', content.path, type=type):
+            rets = content.render()
+        return rets
+    
+    def render_batch(self, indexes):
+        # Renders a batch of items; in low memory mode their bodies and data
+        # are then released together, before the next batch is started.
+        rets = [self.render_item(index) for index in indexes]
+        if self.lowmem:
+            for index in indexes:
+                self.content[index].release()
+            gc.collect()
+        return rets
+    
+    def batches(self):
+        # Workers are given smaller batches on small sites so they all get
+        # something to do.
+        count = len(self.content)
+        size = self.batch
+        if self.workers > 1:
+            size = min(size, count // (self.workers * 4))
+        size = max(1, size)
+        return [list(range(start, min(start + size, count))) for start in range(0, count, size)]
+    
+    def render_content(self):
+        pool = None
+        if self.workers > 1:
+            try:
+                pool = multiprocessing.get_context('fork').Pool(self.workers, _init_worker, (self,))
+            except AttributeError:
+                pool = multiprocessing.Pool(self.workers, _init_worker, (self,))
+            except ValueError:
+                print('Parallel rendering is not supported on this platform, rendering serially.')
+        
+        if pool is None:
+            for indexes in self.batches():
+                for rets in self.render_batch(indexes):
+                    yield rets
+            return
+        
+        try:
+            for (batch, journal, profile) in pool.imap(_render_worker, self.batches()):
+                self.cache.merge(journal)
+                self.profiler.merge(profile)
+                for rets in batch:
+                    yield rets
+        finally:
+            pool.close()
+            pool.join()
+    
     def generate(self):
+        with self.profiler.span('stage', 'load'):
+            self.load_content()
+        with self.profiler.span('stage', 'process'):
+            self.process_content()
+        with self.profiler.span('stage', 'generate'):
+            self.generate_output()
+        if not self.dry_run:
+            with self.profiler.span('stage', 'shutdown'):
+                self.cache.shutdown()
+        if self.lowmem and resource is not None:
+            print('Peak memory usage {:.1f}MB.'.format(self.peak_memory()))
+    
+    def peak_memory(self):
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        if sys.platform == 'darwin':
+            peak = peak / 1024.0
+        return peak / 1024.0
+    
+    def watch_targets(self):
+        paths = set(glob.glob(self.directories['templates'] + os.sep + '*'))
+        directories = set([self.directories['templates']])
+        for (type, expr, mappings, dependencies) in self.sources:
+            paths.update(p for p in glob.glob(expr) if not os.path.isdir(p))
+            if not glob.has_magic(os.path.dirname(expr)):
+                directories.add(os.path.dirname(expr) or os.curdir)
+        for (type, kwargs) in self.processors:
+            paths.update(getattr(sys.modules[__name__], type)(self, **kwargs).files())
+        directories.update(os.path.dirname(p) or os.curdir for p in paths)
+        return (paths, directories)
+    
+    def rebuild(self, changed):
+        start = time.time()
+        self.cache.reset()
+        self.created = set()
+        self.template_sources = {}
+        self.load_templates()
+        self.load_content(changed)
+        self.process_content()
+        self.generate_output()
+        self.save_cache()
+        print('Rebuilt in {:.2f}s.'.format(time.time()-start))
+    
+    def watch(self, interval=0.5):
         self.load_content()
         self.process_content()
         self.generate_output()
-        self.cache.shutdown()
+        self.save_cache()
+        
+        watcher = Watcher(self.watch_targets, interval)
+        print('Watching for changes ({}) ...'.format(watcher.mode))
+        pending = set()
+        try:
+            while True:
+                changed = watcher.wait()
+                for path in sorted(changed):
+                    print('[Changed] %s' % path)
+                # a failed rebuild leaves the cache as it was, and its changes
+                # are picked up again by the next one
+                pending.update(changed)
+                try:
+                    self.rebuild(pending)
+                except Exception:
+                    traceback.print_exc()
+                    self.cache.discard()
+                    print('Rebuild failed, waiting for further changes ...')
+                else:
+                    pending = set()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if not self.dry_run:
+                self.cache.shutdown()
+    
+    def save_cache(self):
+        # A dry run writes nothing, so what it recorded (such as fingerprints
+        # of outputs it did not generate) must not outlive it.
+        if self.dry_run:
+            self.cache.discard()
+        else:
+            self.cache.sync()
+
+class Watcher(object):
+    
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    events = 0x002 | 0x004 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+    
+    def __init__(self, targets, interval=0.5):
+        self.targets = targets
+        self.interval = interval
+        self.watches = {}
+        self.libc = None
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init()
+            if fd >= 0:
+                self.libc = libc
+                self.fd = fd
+        except (OSError, AttributeError):
+            pass
+        self.mode = 'polling' if self.fd is None else 'inotify'
+        
+        paths, directories = self.targets()
+        self.snapshot = self.scan(paths)
+        self.add_watches(directories)
+    
+    def scan(self, paths):
+        snapshot = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_mtime, st.st_size)
+        return snapshot
+    
+    def add_watches(self, directories):
+        if self.fd is None:
+            return
+        for directory in directories:
+            if directory not in self.watches and os.path.isdir(directory):
+                self.watches[directory] = self.libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()), self.events)
+    
+    def sleep(self):
+        if self.fd is None:
+            time.sleep(self.interval)
+            return
+        select.select([self.fd], [], [])
+        # editors often write a file in several steps, let them finish
+        time.sleep(0.05)
+        while select.select([self.fd], [], [], 0)[0]:
+            os.read(self.fd, 65536)
+    
+    def wait(self):
+        while True:
+            self.sleep()
+            paths, directories = self.targets()
+            snapshot = self.scan(paths)
+            changed = set(p for p in set(snapshot) | set(self.snapshot) if snapshot.get(p) != self.snapshot.get(p))
+            self.snapshot = snapshot
+            self.add_watches(directories)
+            if changed:
+                return changed
+
+_worker = None
+
+def _init_worker(engine):
+    global _worker
+    _worker = engine
+    _worker.jinja_env = _worker.create_jinja_env()
+    _worker.templates = {}
+
+def _render_worker(indexes):
+    _worker.cache.begin()
+    _worker.profiler.begin()
+    rets = _worker.render_batch(indexes)
+    return (rets, _worker.cache.end(), _worker.profiler.end())
 
 if __name__ == '__main__':
-    filename = sys.argv[1]
-    settings = imp.load_source('settings', filename)
-    engine = Engine(settings.directories, settings.routes, settings.sources, settings.processors, settings.data)
-    engine.generate()
+    parser = argparse.ArgumentParser(description='Single file static site generator.')
+    parser.add_argument('config', help='path to the configuration file')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='number of processes used to render output')
+    parser.add_argument('--digests', action='store_true', help='detect changes by content digest instead of modification time')
+    parser.add_argument('--store', choices=sorted(Cache.stores.keys()), default='json', help='backend used to store the cache')
+    parser.add_argument('--watch', action='store_true', help='keep running and rebuild whenever a source changes')
+    parser.add_argument('--dry-run', action='store_true', help='list what would be rebuilt without writing anything')
+    parser.add_argument('--low-memory', action='store_true', help='keep less content in memory, at some cost in speed')
+    parser.add_argument('--batch', type=int, default=64, help='number of items rendered before their memory is released in low memory mode')
+    parser.add_argument('--static', choices=list(Engine.statics.keys()), default='copy', help='how static files are put in the output directory')
+    parser.add_argument('--readers', type=int, default=8, help='number of threads used to read the metadata of changed sources')
+    parser.add_argument('--stream', action='store_true', help='write pages to disk while they are rendered instead of rendering them into memory first')
+    parser.add_argument('--profile', metavar='FILE', help='write per stage, type, file, processor and template timings to FILE as JSON')
+    parser.add_argument('--trace', metavar='FILE', help='write a Chrome trace of the build to FILE')
+    args = parser.parse_args()
+    
+    settings = imp.load_source('settings', args.config)
+    engine = Engine(settings.directories, settings.routes, settings.sources, settings.processors, settings.data, workers=args.workers, digests=args.digests, store=args.store, dry_run=args.dry_run, lowmem=args.low_memory, batch=args.batch, markdown=getattr(settings, 'markdown', None), profiler=Profiler(args.profile is not None or args.trace is not None), static=args.static, readers=args.readers, stream=args.stream)
+    if args.watch:
+        engine.watch()
+    else:
+        engine.generate()
+    if args.profile is not None:
+        engine.profiler.save(args.profile)
+    if args.trace is not None:
+        engine.profiler.save_trace(args.trace)